@@ -1,19 +1,21 @@
 #!/usr/bin/env python3
 import sys
 import re
+import html
 import argparse
 import asyncio
 import aiohttp
-import itertools
-import json
+import orjson
 import warnings
-from contextlib import asynccontextmanager
+from contextlib import AsyncExitStack, aclosing, asynccontextmanager, nullcontext
 from http.cookies import BaseCookie
-from urllib.parse import urlparse, urlunparse, urlencode, parse_qs
-from typing import List, Iterator, Optional, Mapping, AsyncIterator, Callable, Awaitable
+from types import SimpleNamespace
+from urllib.parse import urlparse, urlunparse, urlencode, urldefrag, parse_qs
+from typing import Dict, List, Set, Tuple, Iterator, Optional, Mapping, AsyncIterator, AsyncContextManager, Callable, Awaitable
 
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 from aiohttp_retry import RetryClient, ExponentialRetry, EvaluateResponseCallbackType
+from aiolimiter import AsyncLimiter
 
 
 import logging
@@ -27,73 +29,144 @@ VK_API_BASE_URL = 'https://api.vk.com'
 VK_REDIRECT_BLANK_URL = 'https://oauth.vk.com/blank.html'
 VK_RETRY_ERROR_CODES = {1, 6, 10}
 VK_NEVER_RETRY_ERROR_CODES = {5, 9, 29, 223}
+VK_REQUESTS_PER_SECOND = 3
+VK_INVALID_RESPONSE_PREVIEW_SIZE = 512
 
+RATE_LIMIT_STATUSES = {429, 503}
+RETRY_START_TIMEOUT = 0.5
+RETRY_MAX_TIMEOUT = 30
+RETRY_FACTOR = 2
 
-LAST_PAGE_SELECTOR = 'nav.navigation ul.pagination li:nth-last-child(2) a'
+
+PAGINATION_SELECTOR = 'nav.navigation ul.pagination > li'
 CATALOG_SELECTOR = '#main-catalog .product-list__name'
 ARTICLE_SELECTOR = '.catalog-detail__article > span'
+# Fast path for ARTICLE_SELECTOR on the raw item page: the span must directly follow
+# the first element with the article class, otherwise the page is parsed
+ARTICLE_CLASS_RE = re.compile(rb'''class=["'](?:[^"']*\s)?catalog-detail__article(?=[\s"'])[^>]*''')
+ARTICLE_SPAN_RE = re.compile(rb'>\s*<span[^>]*>([^<]+)</span>')
 
-IWAF_JS_COOKIE_RE = re.compile("(iwaf_js_cookie_[^']+)")
+IWAF_JS_COOKIE_RE = re.compile(rb"iwaf_js_cookie_[^']+")
 IWAF_CHALLENGE_PATH = '/iwaf-challenge'
 
+# Workers per queue when the number of concurrent connections is not limited
+DEFAULT_WORKERS_COUNT = 100
 
-async def parse_item(client: RetryClient, item_url: str) -> Optional[str]:
-    page = await fetch_page(client, item_url)
-    if not page:
-        return None
+# Articles and item links repeat across sale pages, keep a single copy of each
+STR_CACHE: Dict[str, str] = {}
+STR_CACHE_MAX_SIZE = 100_000
 
-    article = page.select_one(ARTICLE_SELECTOR)
-    if not article:
-        warnings.warn(f'Article for item "{item_url}" is not found... skip')
-        return None
-    return str(article.string).strip()
 
+def intern_str(s: str) -> str:
+    if len(STR_CACHE) >= STR_CACHE_MAX_SIZE:
+        return STR_CACHE.get(s, s)
+    return STR_CACHE.setdefault(s, s)
 
-async def parse_page(client: RetryClient, url: str) -> List[str]:
-    page = await fetch_page(client, url)
-    if not page:
-        return []
 
-    return await asyncio.gather(*(
-        parse_item(client, item_url)
-        for item_url in get_item_links(page)
-    ))
+async def parse_item(client: RetryClient, sem: AsyncContextManager, item_url: str) -> Optional[str]:
+    fetched = await fetch_body(client, sem, item_url)
+    if not fetched:
+        return None
 
+    body, encoding = fetched
+    class_match = ARTICLE_CLASS_RE.search(body)
+    match = class_match and ARTICLE_SPAN_RE.match(body, class_match.end())
+    if match:
+        return intern_str(html.unescape(match.group(1).decode(encoding, errors='replace')).strip())
 
-def get_item_links(page: BeautifulSoup) -> Iterator[str]:
-    item_links = page.select(CATALOG_SELECTOR)
+    page = await asyncio.to_thread(parse_html, body, encoding)
+    article = page.css_first(ARTICLE_SELECTOR)
+    if not article:
+        warnings.warn(f'Article for item "{item_url}" is not found... skip')
+        return None
+    return intern_str(article.text(strip=True))
+
+
+async def pages_worker(
+    client: RetryClient,
+    sem: AsyncContextManager,
+    pages_queue: 'asyncio.Queue[Optional[str]]',
+    items_queue: 'asyncio.Queue[Optional[str]]',
+    seen_item_urls: Set[str],
+) -> None:
+    while True:
+        url = await pages_queue.get()
+        if url is None:
+            return
+
+        page = await fetch_page(client, sem, url)
+        if page:
+            put_item_links(page, items_queue, seen_item_urls)
+
+
+def put_item_links(
+    page: LexborHTMLParser,
+    items_queue: 'asyncio.Queue[Optional[str]]',
+    seen_item_urls: Set[str],
+) -> None:
+    # Sale pages may repeat the same items, fetch each of them only once
+    for item_url in get_item_links(page):
+        if item_url not in seen_item_urls:
+            seen_item_urls.add(item_url)
+            items_queue.put_nowait(item_url)
+
+
+async def items_worker(
+    client: RetryClient,
+    sem: AsyncContextManager,
+    items_queue: 'asyncio.Queue[Optional[str]]',
+    articles_queue: 'asyncio.Queue[Optional[str]]',
+) -> None:
+    while True:
+        item_url = await items_queue.get()
+        if item_url is None:
+            return
+
+        article = await parse_item(client, sem, item_url)
+        if article:
+            articles_queue.put_nowait(article)
+
+
+def get_item_links(page: LexborHTMLParser) -> Iterator[str]:
+    item_links = page.css(CATALOG_SELECTOR)
     if not item_links:
-        warnings.warn(f'There are no items at page "{page.title}"... skip')
+        title = page.css_first('title')
+        warnings.warn(f'There are no items at page "{title.text(strip=True) if title else ""}"... skip')
         return
 
     for link in item_links:
-        href = link.get_attribute_list('href')
+        href = link.attributes.get('href')
         if href:
-            yield href[0]
+            yield intern_str(urldefrag(href).url)
         else:
-            warnings.warn(f'Item "{link.string}" has not href attribute... skip')
+            warnings.warn(f'Item "{link.text(strip=True)}" has not href attribute... skip')
+
 
+def paginate(page: LexborHTMLParser) -> Iterator[str]:
+    # :nth-last-child() is matched against every <li> on the page, so pick the item by index instead
+    pagination = page.css(PAGINATION_SELECTOR)
+    if len(pagination) < 2:
+        return
 
-def paginate(page: BeautifulSoup) -> Iterator[str]:
-    last_page_link_tag = page.select_one(LAST_PAGE_SELECTOR)
+    last_page_link_tag = pagination[-2].css_first('a')
     if not last_page_link_tag:
         return
 
-    last_page_url = last_page_link_tag.get_attribute_list('href')
+    last_page_url = last_page_link_tag.attributes.get('href')
     if not last_page_url:
         warnings.warn('Last page link has not href attribute... skip pagination')
         return
 
     try:
-        last_page_url_parsed = urlparse(last_page_url[0])
+        last_page_url_parsed = urlparse(last_page_url)
         last_page_url_query = parse_qs(last_page_url_parsed.query)
     except ValueError:
-        warnings.warn(f'Failed to parse last page url "{last_page_url[0]}"')
+        warnings.warn(f'Failed to parse last page url "{last_page_url}"')
         return
 
     last_page = last_page_url_query.get('page')
     if not last_page:
-        warnings.warn(f'There is no ?page in the last page url "{last_page_url[0]}"')
+        warnings.warn(f'There is no ?page in the last page url "{last_page_url}"')
         return
     try:
         parsed_last_page = int(last_page[0])
@@ -101,68 +174,127 @@ def paginate(page: BeautifulSoup) -> Iterator[str]:
         warnings.warn(f'Last page "{last_page[0]}" is not a number')
         return
 
+    # Only ?page differs between page urls, so build the rest of the url once
+    del last_page_url_query['page']
+    base_query = urlencode(last_page_url_query, doseq=True)
+    url_prefix = urlunparse(last_page_url_parsed._replace(query='', fragment=''))
+    query_prefix = f'?{base_query}&page=' if base_query else '?page='
+    url_suffix = f'#{last_page_url_parsed.fragment}' if last_page_url_parsed.fragment else ''
+
     for page_idx in range(2, parsed_last_page + 1):
-        last_page_url_query['page'] = [str(page_idx)]
-        yield urlunparse(last_page_url_parsed._replace(query=urlencode(last_page_url_query, doseq=True)))
+        yield f'{url_prefix}{query_prefix}{page_idx}{url_suffix}'
 
 
 async def iwaf_challenge(resp: aiohttp.ClientResponse, session: aiohttp.ClientSession) -> bool:
     if resp.url.path != IWAF_CHALLENGE_PATH:
         return True
 
-    html = await resp.text()
-    result = IWAF_JS_COOKIE_RE.search(html)
+    # Search the raw body, there is no need to decode the whole challenge page
+    body = await resp.read()
+    result = IWAF_JS_COOKIE_RE.search(body)
     if not result:
         warnings.warn('Failed to proceed iwaf challenge: js cookie not found... retry')
         return False
 
-    iwaf_cookie = result.group(0)
+    iwaf_cookie = result.group(0).decode()
     session.cookie_jar.update_cookies(BaseCookie(iwaf_cookie), resp.url)
     return False
 
 
-async def fetch_page(client: RetryClient, url: str) -> Optional[BeautifulSoup]:
-    try:
-        resp = await client.get(url)
-    except aiohttp.ClientError as e:
-        warnings.warn(f'Failed to load page {url}... skip ({e})')
+async def fetch_body(client: RetryClient, sem: AsyncContextManager, url: str) -> Optional[Tuple[bytes, str]]:
+    async with sem:
+        try:
+            resp = await client.get(url)
+            body = await resp.read()
+        except aiohttp.ClientError as e:
+            warnings.warn(f'Failed to load page {url}... skip ({e})')
+            return None
+
+    return body, resp.get_encoding()
+
+
+async def fetch_page(client: RetryClient, sem: AsyncContextManager, url: str) -> Optional[LexborHTMLParser]:
+    fetched = await fetch_body(client, sem, url)
+    if not fetched:
         return None
 
-    html = await resp.text()
-    page = BeautifulSoup(html, 'html.parser')
+    # Parsing releases the GIL, so it does not have to block the event loop
+    page = await asyncio.to_thread(parse_html, *fetched)
     return page
 
 
+def parse_html(body: bytes, encoding: str) -> LexborHTMLParser:
+    return LexborHTMLParser(body.decode(encoding, errors='replace'))
+
+
 def parse_args(args: List[str] = sys.argv[1:]) -> argparse.Namespace:
     parser = argparse.ArgumentParser(description='Парсит артикулы с сайта Спорт-Марафона и отсылает отдельными комментариями к посту ВКонтакте')
     parser.add_argument('-t', '--token', help='Токен доступа к API VK из URL браузера')
     parser.add_argument('-p', '--post', default='-45599639_85065', help='ID поста, в который отправить комментарии (vk.com/wall<POST>)')
     parser.add_argument('-u', '--url', default='https://sport-marafon.ru/rasprodazha/', help='Адрес раздела товаров Спорт-Марафона, с которого парсить')
-    parser.add_argument('-c', '--connections', type=int, default=10, help='Количество одновременных соединений')
+    parser.add_argument('-c', '--connections', type=int, default=100, help='Общее количество одновременных соединений (0 - без ограничения)')
+    parser.add_argument('--per-host', type=int, default=64, help='Количество одновременных соединений с одним хостом (0 - без ограничения)')
     parser.add_argument('-r', '--retries', type=int, default=3, help='Количество повторных запросов при ошибке')
     return parser.parse_args(args)
 
 
+class RetryAfterExponentialRetry(ExponentialRetry):
+    def get_timeout(self, attempt: int, response: Optional[aiohttp.ClientResponse] = None) -> float:
+        if response is not None and response.status in RATE_LIMIT_STATUSES:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                return min(float(retry_after), self._max_timeout)
+        return super().get_timeout(attempt, response)
+
+
+def make_connector(connections_limit: int = 100, per_host_limit: int = 64) -> aiohttp.TCPConnector:
+    return aiohttp.TCPConnector(
+        limit=connections_limit,
+        limit_per_host=per_host_limit,
+        ttl_dns_cache=300,
+    )
+
+
 @asynccontextmanager
 async def make_client(
     base_url: str,
+    connector: aiohttp.BaseConnector,
     headers: Optional[Mapping] = None,
-    connections_limit: int = 10,
     retries: int = 3,
     eval_resp_cb: Optional[Callable[[aiohttp.ClientResponse, aiohttp.ClientSession], Awaitable[bool]]] = None,
+    limiter: Optional[AsyncLimiter] = None,
 ) -> AsyncIterator[RetryClient]:
-    connector = aiohttp.TCPConnector(limit=connections_limit)
+    trace_configs = []
+    if limiter:
+        # RetryClient retries inside a single call, so every attempt has to wait for the limiter itself
+        async def acquire_limiter(session: aiohttp.ClientSession, ctx: SimpleNamespace, params: aiohttp.TraceRequestStartParams):
+            await limiter.acquire()
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(acquire_limiter)
+        trace_configs.append(trace_config)
+
+    # The connector is shared between clients and is closed by its owner
     async with aiohttp.ClientSession(
         base_url=base_url,
         connector=connector,
+        connector_owner=False,
         headers=headers,
+        trace_configs=trace_configs,
     ) as session:
         async def binded_eval_resp_cb(resp: aiohttp.ClientResponse):
             if not eval_resp_cb:
                 return True
             return await eval_resp_cb(resp, session)
 
-        retry_options = ExponentialRetry(evaluate_response_callback=binded_eval_resp_cb, attempts=retries)
+        retry_options = RetryAfterExponentialRetry(
+            attempts=retries,
+            start_timeout=RETRY_START_TIMEOUT,
+            max_timeout=RETRY_MAX_TIMEOUT,
+            factor=RETRY_FACTOR,
+            statuses=RATE_LIMIT_STATUSES,
+            evaluate_response_callback=binded_eval_resp_cb,
+        )
         client = RetryClient(
             retry_options=retry_options,
             client_session=session,
@@ -171,40 +303,97 @@ async def make_client(
         yield client
 
 
-async def parse(client: RetryClient, path: str, connections_limit: int = 10, retries: int = 3) -> Iterator[str]:
-    page = await fetch_page(client, path)
-    if not page:
-        return iter([])
+def make_semaphore(limit: int) -> AsyncContextManager:
+    return asyncio.Semaphore(limit) if limit > 0 else nullcontext()
 
-    first_page_items_task = asyncio.gather(*(
-        parse_item(client, item_url)
-        for item_url in get_item_links(page)
-    ))
-    other_pages_items_task = asyncio.gather(*(
-        parse_page(client, page_url) for page_url in paginate(page)
-    ))
-    first_page_items, other_pages_items = await asyncio.gather(first_page_items_task, other_pages_items_task)
-    return (item for item in itertools.chain(first_page_items, *other_pages_items) if item)
 
+async def parse(client: RetryClient, path: str, concurrency_limit: int = 64) -> AsyncIterator[str]:
+    # Bounds the number of pages being downloaded (and held in memory) at once
+    sem = make_semaphore(concurrency_limit)
+    workers_count = concurrency_limit if concurrency_limit > 0 else DEFAULT_WORKERS_COUNT
+    pages_queue: asyncio.Queue[Optional[str]] = asyncio.Queue()
+    items_queue: asyncio.Queue[Optional[str]] = asyncio.Queue()
+    articles_queue: asyncio.Queue[Optional[str]] = asyncio.Queue()
+    seen_item_urls: Set[str] = set()
 
-async def comment_for_post(client: RetryClient, token: str, post: str, message: str) -> None:
+    page = await fetch_page(client, sem, path)
+    if not page:
+        return
+
+    # Items of the first page are fetched while the other pages are still loading
+    put_item_links(page, items_queue, seen_item_urls)
+    for page_url in paginate(page):
+        pages_queue.put_nowait(page_url)
+    del page
+
+    pages_workers = [
+        asyncio.create_task(pages_worker(client, sem, pages_queue, items_queue, seen_item_urls))
+        for _ in range(workers_count)
+    ]
+    items_workers = [
+        asyncio.create_task(items_worker(client, sem, items_queue, articles_queue))
+        for _ in range(workers_count)
+    ]
+
+    # None is a sentinel which stops a worker once the queue before it is drained
+    async def stop_workers() -> None:
+        try:
+            for _ in pages_workers:
+                pages_queue.put_nowait(None)
+            await asyncio.gather(*pages_workers)
+            for _ in items_workers:
+                items_queue.put_nowait(None)
+            await asyncio.gather(*items_workers)
+        finally:
+            articles_queue.put_nowait(None)
+
+    stopping = asyncio.create_task(stop_workers())
+    try:
+        while True:
+            article = await articles_queue.get()
+            if article is None:
+                break
+            yield article
+        await stopping
+    finally:
+        for task in (stopping, *pages_workers, *items_workers):
+            task.cancel()
+
+
+def make_comment_body_factory(token: str, post: str) -> Callable[[str], Dict[str, str]]:
     owner_id, post_id = post.split('_')
-    body = {
+    base_body = {
         'access_token': token,
         'owner_id': owner_id,
         'post_id': post_id,
-        'message': message,
         'v': VK_API_VERSION,
     }
 
+    def make_comment_body(message: str) -> Dict[str, str]:
+        return base_body | {'message': message}
+
+    return make_comment_body
+
+
+async def comment_for_post(
+    client: RetryClient,
+    make_comment_body: Callable[[str], Dict[str, str]],
+    message: str,
+) -> None:
+    body = make_comment_body(message)
+
     try:
-        resp = await client.post('/method/wall.createComment', data=urlencode(body, doseq=True))
-        data = await resp.json()
+        resp = await client.post('/method/wall.createComment', data=body)
+        raw = await resp.read()
     except aiohttp.ClientError as e:
         warnings.warn(f'Failed to post comment {message}... skip ({e})')
         return
-    except json.JSONDecodeError:
-        warnings.warn(f'Invalid response from VK... skip ({await resp.text()})')
+
+    try:
+        data = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        preview = raw[:VK_INVALID_RESPONSE_PREVIEW_SIZE].decode(errors='replace')
+        warnings.warn(f'Invalid response from VK... skip ({preview})')
         return
 
     error = data.get('error')
@@ -216,8 +405,8 @@ async def comment_for_post(client: RetryClient, token: str, post: str, message:
 
 async def eval_resp_vk(resp: aiohttp.ClientResponse, session: aiohttp.ClientSession) -> bool:
     try:
-        data = await resp.json()
-    except json.JSONDecodeError:
+        data = orjson.loads(await resp.read())
+    except orjson.JSONDecodeError:
         return False
 
     error = data.get('error')
@@ -230,27 +419,47 @@ async def eval_resp_vk(resp: aiohttp.ClientResponse, session: aiohttp.ClientSess
     return code in VK_NEVER_RETRY_ERROR_CODES
 
 
-async def parse_then_send(url: str, token: str, post: str, connections_limit: int = 10, retries: int = 3) -> None:
-    async with make_client(
-        base_url=urlunparse(urlparse(url)._replace(path='')),
-        headers={'user-agent': 'Python aiohttp'},
-        connections_limit=connections_limit,
-        eval_resp_cb=iwaf_challenge,
-        retries=retries,
-    ) as client:
-        articles = await parse(client, url, connections_limit, retries)
-
-    async with make_client(
-        base_url=VK_API_BASE_URL,
-        headers={'Content-Type': 'application/x-www-form-urlencoded'},
-        connections_limit=connections_limit,
-        eval_resp_cb=eval_resp_vk,
-        retries=retries,
-    ) as client:
-        await asyncio.gather(*(
-            comment_for_post(client, token, post, article)
-            for article in articles
+async def parse_then_send(
+    url: str,
+    token: str,
+    post: str,
+    connections_limit: int = 100,
+    per_host_limit: int = 64,
+    retries: int = 3,
+) -> None:
+    async with AsyncExitStack() as stack:
+        # Both clients reuse the same connection pool and DNS cache
+        connector = await stack.enter_async_context(make_connector(connections_limit, per_host_limit))
+        parse_client = await stack.enter_async_context(make_client(
+            base_url=urlunparse(urlparse(url)._replace(path='')),
+            connector=connector,
+            headers={'user-agent': 'Python aiohttp'},
+            eval_resp_cb=iwaf_challenge,
+            retries=retries,
         ))
+        vk_client = await stack.enter_async_context(make_client(
+            base_url=VK_API_BASE_URL,
+            connector=connector,
+            eval_resp_cb=eval_resp_vk,
+            retries=retries,
+            limiter=AsyncLimiter(VK_REQUESTS_PER_SECOND, 1),
+        ))
+        make_comment_body = make_comment_body_factory(token, post)
+        sem = asyncio.Semaphore(per_host_limit if per_host_limit > 0 else DEFAULT_WORKERS_COUNT)
+
+        async def send(article: str) -> None:
+            try:
+                await comment_for_post(vk_client, make_comment_body, article)
+            finally:
+                sem.release()
+
+        # Comments are posted while the rest of the articles are still being parsed.
+        # A slot is taken before the task is created, so only the in-flight comments are kept in memory.
+        # The task group waits for (or cancels, on error) every comment before the clients are closed
+        async with asyncio.TaskGroup() as tg, aclosing(parse(parse_client, url, per_host_limit)) as articles:
+            async for article in articles:
+                await sem.acquire()
+                tg.create_task(send(article))
 
 
 def main():
@@ -273,9 +482,14 @@ def main():
         print('Copy access_token from browser URL')
         return
 
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(parse_then_send(args.url, args.token, args.post, args.connections, args.retries))
-    loop.close()
+    try:
+        import uvloop
+        loop_factory = uvloop.new_event_loop
+    except ImportError:
+        loop_factory = None
+
+    with asyncio.Runner(loop_factory=loop_factory) as runner:
+        runner.run(parse_then_send(args.url, args.token, args.post, args.connections, args.per_host, args.retries))
 
 
 if __name__ == '__main__':